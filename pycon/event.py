@@ -10,6 +10,7 @@ class ButtonEventJoyCon(PythonicJoyCon):
         self._event_handlers = {}
         self._event_track_sticks = track_sticks
 
+        self._previous_buttons = 0
         self._previous_stick_l_btn = 0
         self._previous_stick_r_btn = 0
         self._previous_stick_r  = self._previous_stick_l  = (0, 0)
@@ -38,6 +39,12 @@ class ButtonEventJoyCon(PythonicJoyCon):
 
     @staticmethod
     def _event_tracking_update_hook_right(self):
+        # Nothing to do while no button changed since the last report
+        buttons = self.get_all_buttons()
+        if buttons == self._previous_buttons:
+            return
+        self._previous_buttons = buttons
+
         if self._event_track_sticks:
             pressed = self.stick_r_btn
             if self._previous_stick_r_btn != pressed:
@@ -86,6 +93,12 @@ class ButtonEventJoyCon(PythonicJoyCon):
 
     @staticmethod
     def _event_tracking_update_hook_left(self):
+        # Nothing to do while no button changed since the last report
+        buttons = self.get_all_buttons()
+        if buttons == self._previous_buttons:
+            return
+        self._previous_buttons = buttons
+
         if self._event_track_sticks:
             pressed = self.stick_l_btn
             if self._previous_stick_l_btn != pressed:
@@ -1,19 +1,86 @@
+import struct
 import time
-from threading import Thread
+import traceback
+from threading import Event, Lock, Thread
 from typing import Optional, Tuple
 
 import hid
 
 from .constants import (JOYCON_L_PRODUCT_ID, JOYCON_PRODUCT_IDS,
-                        JOYCON_R_PRODUCT_ID, JOYCON_VENDOR_ID)
+                        JOYCON_VENDOR_ID)
 
 # TODO: disconnect, power off sequence
 
 
+class _HidPollPool:
+    # Reads the input reports of every open JoyCon from one shared daemon
+    # thread instead of starting one thread per JoyCon. The bindings don't
+    # expose a pollable fd, so devices are read in turn with a timeout that
+    # makes a full pass last about one report period. A single JoyCon gets
+    # a long blocking read, like a dedicated thread would. hidapi queues
+    # reports meanwhile, nothing is lost.
+
+    def __init__(self):
+        self._joycons = ()
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+
+    def register(self, joycon):
+        with self._lock:
+            self._joycons += (joycon,)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def unregister(self, joycon):
+        with self._lock:
+            self._joycons = tuple(j for j in self._joycons if j is not joycon)
+
+    @staticmethod
+    def _read_timeout(count):  # ms, per JoyCon on each pass
+        if count == 1:
+            return JoyCon._INPUT_REPORT_TIMEOUT
+        return max(1, int(JoyCon._INPUT_REPORT_PERIOD * 1000) // count)
+
+    def _run(self):  # daemon thread
+        try:
+            while True:
+                joycons = self._joycons
+                if not joycons:
+                    self._wakeup.wait()
+                    self._wakeup.clear()
+                    continue
+
+                timeout = self._read_timeout(len(joycons))
+                for joycon in joycons:
+                    # A failing JoyCon must not stop the others
+                    try:
+                        alive = joycon._update_input_report(timeout)
+                    except Exception:
+                        traceback.print_exc()
+                        alive = False
+
+                    if not alive:
+                        self.unregister(joycon)
+        finally:
+            with self._lock:
+                self._thread = None
+
+
+_hid_poll_pool = _HidPollPool()
+
+
 class JoyCon:
     _INPUT_REPORT_SIZE = 49
+    _OUTPUT_REPORT_SIZE = 49
     _INPUT_REPORT_PERIOD = 0.015
+    _INPUT_REPORT_TIMEOUT = 100  # ms
+    _SUBCMD_RESPONSE_TIMEOUT = 1.0  # s
     _RUMBLE_DATA = b'\x00\x01\x40\x40\x00\x01\x40\x40'
+    # 3 samples of accel xyz, each followed by 6 bytes of gyro data
+    _ACCELS_STRUCT = struct.Struct('<3h6x3h6x3h')
 
     vendor_id: int
     product_id: int
@@ -35,10 +102,24 @@ class JoyCon:
         self.serial = serial
         self.simple_mode = simple_mode  # TODO: It's for reporting mode 0x3f
 
+        # cache per-side values used on every poll
+        self._is_left = product_id == JOYCON_L_PRODUCT_ID
+        self._accel_yz_sign = 1 if self._is_left else -1
+        # (horizontal lo, horizontal hi, vertical lo, vertical hi) bytes of the stick
+        self._stick_offsets = (6, 7, 7, 8) if self._is_left else (9, 10, 10, 11)
+
         # setup internal state
         self._input_hooks = []
+        self._input_hook_dispatch = None
         self._input_report = bytes(self._INPUT_REPORT_SIZE)
+        # held by the poll thread while it reads, so _close can't free the
+        # device under it
+        self._device_lock = Lock()
         self._packet_number = 0
+        self._output_report = bytearray(self._OUTPUT_REPORT_SIZE)
+        self._output_report[2:10] = self._RUMBLE_DATA
+        self._output_report_padding = bytes(self._OUTPUT_REPORT_SIZE - 11)
+        self._last_output_report = bytes(self._OUTPUT_REPORT_SIZE)
         self.set_accel_calibration((0, 0, 0), (1, 1, 1))
 
         # connect to joycon
@@ -46,10 +127,14 @@ class JoyCon:
         self._read_joycon_data()
         self._setup_sensors()
 
-        # start talking with the joycon in a daemon thread
-        Thread(target=self._update_input_report, daemon=True).start()
+        # start talking with the joycon in the shared poll thread
+        _hid_poll_pool.register(self)
 
     def _open(self, vendor_id, product_id, serial):
+        # Both supported bindings release the GIL while blocked in
+        # hid_read/hid_write (cython-hidapi wraps them in `with nogil`,
+        # hid goes through ctypes), so reads from several JoyCons and the
+        # main thread don't serialize on it.
         try:
             if hasattr(hid, "device"):  # hidapi
                 _joycon_device = hid.device()
@@ -63,38 +148,56 @@ class JoyCon:
         return _joycon_device
 
     def _close(self):
+        _hid_poll_pool.unregister(self)
+        # wait for a read in progress on the poll thread to return
+        with self._device_lock:
+            if self._joycon_device:
+                self._joycon_device.close()
+                self._joycon_device = None
+
+    def _read_input_report(self, timeout=None) -> bytes:
+        # Returns an empty report when nothing arrived before the timeout (ms)
         if self._joycon_device:
-            self._joycon_device.close()
-            self._joycon_device = None
+            return bytes(self._joycon_device.read(self._INPUT_REPORT_SIZE, timeout or self._INPUT_REPORT_TIMEOUT))
+        return b''
 
-    def _read_input_report(self) -> bytes:
-        if self._joycon_device:
-            return bytes(self._joycon_device.read(self._INPUT_REPORT_SIZE))
-
-    def _write_output_report(self, command, subcommand, argument):
+    def _write_output_report(self, command, subcommand, argument, skip_unchanged=False):
         if not self._joycon_device:
             return
 
-        # TODO: add documentation
-        self._joycon_device.write(b''.join([
-            command,
-            self._packet_number.to_bytes(1, byteorder='little'),
-            self._RUMBLE_DATA,
-            subcommand,
-            argument,
-        ]))
+        # command, packet number, rumble data, subcommand, argument, zero padding
+        buf = self._output_report
+        buf[0] = command[0]
+        buf[1] = self._packet_number
+        buf[10] = subcommand[0]
+        buf[11:] = self._output_report_padding
+        buf[11:11 + len(argument)] = argument
+        report = bytes(buf)
+
+        # Only for subcommands that set a state and whose reply nobody waits
+        # for: everything but the packet number is unchanged, don't resend it
+        if skip_unchanged:
+            last = self._last_output_report
+            if report[0] == last[0] and report[2:] == last[2:]:
+                return
+
+        self._joycon_device.write(report)
+        self._last_output_report = report
         self._packet_number = (self._packet_number + 1) & 0xF
 
     def _send_subcmd_get_response(self, subcommand, argument) -> Tuple[bool, bytes]:
         # TODO: handle subcmd when daemon is running
         self._write_output_report(b'\x01', subcommand, argument)
 
-        report = [0]
-        while report[0] != 0x21:  # TODO, avoid this, await daemon instead
+        # Skip other reports (e.g. 0x30 while already streaming) and replies to
+        # other subcommands until the deadline. Byte 14 echoes the subcommand id.
+        deadline = time.monotonic() + self._SUBCMD_RESPONSE_TIMEOUT
+        while True:  # TODO, avoid this, await daemon instead
             report = self._read_input_report()
-
-        # TODO, remove, see the todo above
-        assert report[1:2] != subcommand, "THREAD carefully"
+            if report and report[0] == 0x21 and report[14] == subcommand[0]:
+                break
+            if time.monotonic() >= deadline:
+                raise IOError(f'No response to subcommand {subcommand!r}')
 
         # TODO: determine if the cut bytes are worth anything
 
@@ -107,31 +210,50 @@ class JoyCon:
         if not ack:
             raise IOError("After SPI read @ {address:#06x}: got NACK")
 
-        if report[:2] != b'\x90\x10':
+        if report[0] != 0x90 or report[1] != 0x10:
             raise IOError("Something else than the expected ACK was recieved!")
         assert report[2:7] == argument, (report[2:5], argument)
 
         return report[7:size + 7]
 
-    def _update_input_report(self):  # daemon thread
+    def _update_input_report(self, timeout) -> bool:  # poll thread
+        # Reads at most one report, returns False once the JoyCon is gone
         try:
-            while self._joycon_device:
-                report = [0]
-                # TODO, handle input reports of type 0x21 and 0x3f
-                while report[0] != 0x30:
-                    report = self._read_input_report()
+            with self._device_lock:
+                report = self._read_input_report(timeout)
+        except (OSError, ValueError):
+            print('connection closed')
+            return False
 
-                self._input_report = report
+        # TODO, handle input reports of type 0x21 and 0x3f
+        if report and report[0] == 0x30:
+            # Publish the new report by swapping the reference. Reports are
+            # immutable, so readers that keep a local reference always decode
+            # a consistent frame without copying or locking.
+            self._input_report = report
 
-                # Call input hooks in a different thread
-                Thread(target=self._input_hook_caller, daemon=True).start()
-        except OSError:
-            print('connection closed')
-            pass
+            # Call input hooks in a different thread
+            dispatch = self._input_hook_dispatch
+            if dispatch is not None:
+                Thread(target=dispatch, args=(self,), daemon=True).start()
 
-    def _input_hook_caller(self):
-        for callback in self._input_hooks:
-            callback(self)
+        return self._joycon_device is not None
+
+    @staticmethod
+    def _compose_input_hooks(hooks):
+        # Build the callable the poll thread runs for each report, so it
+        # doesn't need to walk self._input_hooks (or do anything without hooks)
+        if not hooks:
+            return None
+        if len(hooks) == 1:
+            return hooks[0]
+
+        hooks = tuple(hooks)
+
+        def dispatch(joycon):
+            for callback in hooks:
+                callback(joycon)
+        return dispatch
 
     def _read_joycon_data(self):
         color_data = self._spi_flash_read(0x6050, 6)
@@ -153,15 +275,10 @@ class JoyCon:
             # print(f"Calibrate {self.serial} IME with factory data")
             imu_cal = self._spi_flash_read(0x6020, 24)
 
-        self.set_accel_calibration((
-            self._to_int16le_from_2bytes(imu_cal[0], imu_cal[1]),
-            self._to_int16le_from_2bytes(imu_cal[2], imu_cal[3]),
-            self._to_int16le_from_2bytes(imu_cal[4], imu_cal[5]),
-        ), (
-            self._to_int16le_from_2bytes(imu_cal[6], imu_cal[7]),
-            self._to_int16le_from_2bytes(imu_cal[8], imu_cal[9]),
-            self._to_int16le_from_2bytes(imu_cal[10], imu_cal[11]),
-        ))
+        self.set_accel_calibration(
+            struct.unpack_from('<3h', imu_cal, 0),
+            struct.unpack_from('<3h', imu_cal, 6),
+        )
 
     def _read_stick_calibration_data(self):
         user_stick_cal_addr = 0x8012 if self.is_left() else 0x801D
@@ -177,34 +294,33 @@ class JoyCon:
             factory_stick_cal_addr = 0x603D if self.is_left() else 0x6046
             buf = self._spi_flash_read(factory_stick_cal_addr, 9)
 
-        self.stick_cal = [0] * 6
-
-        # X Axis Max above center
-        self.stick_cal[0 if self.is_left() else 2] = (buf[1] << 8) & 0xF00 | buf[0]
-        # Y Axis Max above center
-        self.stick_cal[1 if self.is_left() else 3] = (buf[2] << 4) | (buf[1] >> 4)
-        # X Axis Center
-        self.stick_cal[2 if self.is_left() else 4] = (buf[4] << 8) & 0xF00 | buf[3]
-        # Y Axis Center
-        self.stick_cal[3 if self.is_left() else 5] = (buf[5] << 4) | (buf[4] >> 4)
-        # X Axis Min below center
-        self.stick_cal[4 if self.is_left() else 0] = (buf[7] << 8) & 0xF00 | buf[6]
-        # Y Axis Min below center
-        self.stick_cal[5 if self.is_left() else 1] = (buf[8] << 4) | (buf[7] >> 4)
+        # 6 packed 12-bit values
+        packed = int.from_bytes(buf[:9], 'little')
+        values = [(packed >> (12 * i)) & 0xFFF for i in range(6)]
+
+        if self.is_left():
+            # X/Y max above center, X/Y center, X/Y min below center
+            self.stick_cal = values
+        else:
+            # X/Y center, X/Y min below center, X/Y max above center
+            self.stick_cal = values[4:] + values[:4]
+
+        # used by get_actual_stick_value to multiply instead of divide
+        cal = self.stick_cal
+        self._stick_center = (cal[2], cal[3])
+        self._stick_pos_inv = tuple(1.0 / c if c else 0.0 for c in cal[0:2])
+        self._stick_neg_inv = tuple(1.0 / c if c else 0.0 for c in cal[4:6])
 
     def _setup_sensors(self):
-        # Enable 6 axis sensors
-        self._write_output_report(b'\x01', b'\x40', b'\x01')
-        # It needs delta time to update the setting
-        time.sleep(0.02)
+        # Enable 6 axis sensors, wait for the ack instead of a fixed delay
+        self._send_subcmd_get_response(b'\x40', b'\x01')
         # Change format of input report
-        self._write_output_report(b'\x01', b'\x03', b'\x30')
+        self._send_subcmd_get_response(b'\x03', b'\x30')
 
     @staticmethod
     def _to_int16le_from_2bytes(hbytebe, lbytebe):
-        uint16le = (lbytebe << 8) | hbytebe
-        int16le = uint16le if uint16le < 32768 else uint16le - 65536
-        return int16le
+        # branchless sign extension of the uint16
+        return (((lbytebe << 8) | hbytebe) ^ 0x8000) - 0x8000
 
     def _get_nbit_from_input_report(self, offset_byte, offset_bit, nbit):
         byte = self._input_report[offset_byte]
@@ -223,23 +339,30 @@ class JoyCon:
             self._ACCEL_COEFF_Z = (1.0 / (cz - self._ACCEL_OFFSET_Z)) * 4.0
 
     def get_actual_stick_value(self, pre_cal, orientation):  # X/Horizontal = 0, Y/Vertical = 1
-        diff = pre_cal - self.stick_cal[2 + orientation]
+        diff = pre_cal - self._stick_center[orientation]
         if (abs(diff) < self.deadzone):
             return 0
         elif diff > 0:  # Axis is above center
-            return diff / self.stick_cal[orientation]
+            return diff * self._stick_pos_inv[orientation]
         else:
-            return diff / self.stick_cal[4 + orientation]
+            return diff * self._stick_neg_inv[orientation]
 
     def register_update_hook(self, callback):
         self._input_hooks.append(callback)
+        self._input_hook_dispatch = self._compose_input_hooks(self._input_hooks)
         return callback  # this makes it so you could use it as a decorator
 
     def is_left(self):
-        return self.product_id == JOYCON_L_PRODUCT_ID
+        return self._is_left
 
     def is_right(self):
-        return self.product_id == JOYCON_R_PRODUCT_ID
+        return not self._is_left
+
+    def get_all_buttons(self):
+        """All 24 button bits of the report as one int, e.g. to detect
+        changes between two polls with a single XOR."""
+        r = self._input_report
+        return r[3] | (r[4] << 8) | (r[5] << 16)
 
     def get_battery_charging(self):
         return self._get_nbit_from_input_report(2, 4, 1)
@@ -316,49 +439,47 @@ class JoyCon:
     def get_button_zl(self):
         return self._get_nbit_from_input_report(5, 7, 1)
 
-    def get_stick_left_horizontal(self):
-        if not self.is_left():
-            return 0
+    def _get_stick_horizontal(self, input_report):
+        lo, hi = self._stick_offsets[0], self._stick_offsets[1]
+        return self.get_actual_stick_value(input_report[lo] | ((input_report[hi] & 0xF) << 8), 0)
 
-        pre_cal = self._get_nbit_from_input_report(6, 0, 8) \
-            | (self._get_nbit_from_input_report(7, 0, 4) << 8)
-        return self.get_actual_stick_value(pre_cal, 0)
+    def _get_stick_vertical(self, input_report):
+        lo, hi = self._stick_offsets[2], self._stick_offsets[3]
+        return self.get_actual_stick_value((input_report[lo] >> 4) | (input_report[hi] << 4), 1)
 
-    def get_stick_left_vertical(self):
-        if not self.is_left():
-            return 0
+    def _get_stick_values(self, input_report):
+        return (
+            self._get_stick_horizontal(input_report),
+            self._get_stick_vertical(input_report),
+        )
 
-        pre_cal = self._get_nbit_from_input_report(7, 4, 4) \
-            | (self._get_nbit_from_input_report(8, 0, 8) << 4)
-        return self.get_actual_stick_value(pre_cal, 1)
+    def get_stick_left_horizontal(self):
+        return self._get_stick_horizontal(self._input_report) if self._is_left else 0
 
-    def get_stick_right_horizontal(self):
-        if self.is_left():
-            return 0
+    def get_stick_left_vertical(self):
+        return self._get_stick_vertical(self._input_report) if self._is_left else 0
 
-        pre_cal = self._get_nbit_from_input_report(9, 0, 8) \
-            | (self._get_nbit_from_input_report(10, 0, 4) << 8)
-        return self.get_actual_stick_value(pre_cal, 0)
+    def get_stick_right_horizontal(self):
+        return 0 if self._is_left else self._get_stick_horizontal(self._input_report)
 
     def get_stick_right_vertical(self):
-        if self.is_left():
-            return 0
+        return 0 if self._is_left else self._get_stick_vertical(self._input_report)
 
-        pre_cal = self._get_nbit_from_input_report(10, 4, 4) \
-            | (self._get_nbit_from_input_report(11, 0, 8) << 4)
-        return self.get_actual_stick_value(pre_cal, 1)
+    def _get_accels(self, input_report):
+        v = self._ACCELS_STRUCT.unpack_from(input_report, 13)
+        sign = self._accel_yz_sign
+        cx = self._ACCEL_COEFF_X
+        cy = self._ACCEL_COEFF_Y * sign
+        cz = self._ACCEL_COEFF_Z * sign
 
-    def get_accels(self):
-        input_report = bytes(self._input_report)
-        accels = []
+        return [
+            (v[0] * cx, v[1] * cy, v[2] * cz),
+            (v[3] * cx, v[4] * cy, v[5] * cz),
+            (v[6] * cx, v[7] * cy, v[8] * cz),
+        ]
 
-        for idx in range(3):
-            x = self.get_accel_x(input_report, sample_idx=idx)
-            y = self.get_accel_y(input_report, sample_idx=idx)
-            z = self.get_accel_z(input_report, sample_idx=idx)
-            accels.append((x, y, z))
-
-        return accels
+    def get_accels(self):
+        return self._get_accels(self._input_report)
 
     def get_accel_x(self, input_report=None, sample_idx=0):
         if not input_report:
@@ -380,7 +501,7 @@ class JoyCon:
         data = self._to_int16le_from_2bytes(
             input_report[15 + sample_idx * 12],
             input_report[16 + sample_idx * 12])
-        return data * self._ACCEL_COEFF_Y * (1 if self.is_left() else -1)
+        return data * self._ACCEL_COEFF_Y * self._accel_yz_sign
 
     def get_accel_z(self, input_report=None, sample_idx=0):
         if not input_report:
@@ -391,58 +512,75 @@ class JoyCon:
         data = self._to_int16le_from_2bytes(
             input_report[17 + sample_idx * 12],
             input_report[18 + sample_idx * 12])
-        return data * self._ACCEL_COEFF_Z * (1 if self.is_left() else -1)
+        return data * self._ACCEL_COEFF_Z * self._accel_yz_sign
 
     def get_status(self) -> dict:
+        # Decode everything from a single snapshot of the report instead of
+        # going through the getters, this is the hot path when polling, and
+        # every value comes from the same frame.
+        r = self._input_report
+        b2 = r[2]
+        bits = r[3] | (r[4] << 8) | (r[5] << 16)
+
+        if self._is_left:
+            stick_left, stick_right = self._get_stick_values(r), (0, 0)
+        else:
+            stick_left, stick_right = (0, 0), self._get_stick_values(r)
+
         return {
             "battery": {
-                "charging": self.get_battery_charging(),
-                "level": self.get_battery_level(),
+                "charging": (b2 >> 4) & 1,
+                "level": (b2 >> 5) & 7,
             },
             "buttons": {
                 "right": {
-                    "y": self.get_button_y(),
-                    "x": self.get_button_x(),
-                    "b": self.get_button_b(),
-                    "a": self.get_button_a(),
-                    "sr": self.get_button_right_sr(),
-                    "sl": self.get_button_right_sl(),
-                    "r": self.get_button_r(),
-                    "zr": self.get_button_zr(),
+                    "y": bits & 1,
+                    "x": (bits >> 1) & 1,
+                    "b": (bits >> 2) & 1,
+                    "a": (bits >> 3) & 1,
+                    "sr": (bits >> 4) & 1,
+                    "sl": (bits >> 5) & 1,
+                    "r": (bits >> 6) & 1,
+                    "zr": (bits >> 7) & 1,
                 },
                 "shared": {
-                    "minus": self.get_button_minus(),
-                    "plus": self.get_button_plus(),
-                    "r-stick": self.get_button_r_stick(),
-                    "l-stick": self.get_button_l_stick(),
-                    "home": self.get_button_home(),
-                    "capture": self.get_button_capture(),
-                    "charging-grip": self.get_button_charging_grip(),
+                    "minus": (bits >> 8) & 1,
+                    "plus": (bits >> 9) & 1,
+                    "r-stick": (bits >> 10) & 1,
+                    "l-stick": (bits >> 11) & 1,
+                    "home": (bits >> 12) & 1,
+                    "capture": (bits >> 13) & 1,
+                    "charging-grip": (bits >> 15) & 1,
                 },
                 "left": {
-                    "down": self.get_button_down(),
-                    "up": self.get_button_up(),
-                    "right": self.get_button_right(),
-                    "left": self.get_button_left(),
-                    "sr": self.get_button_left_sr(),
-                    "sl": self.get_button_left_sl(),
-                    "l": self.get_button_l(),
-                    "zl": self.get_button_zl(),
+                    "down": (bits >> 16) & 1,
+                    "up": (bits >> 17) & 1,
+                    "right": (bits >> 18) & 1,
+                    "left": (bits >> 19) & 1,
+                    "sr": (bits >> 20) & 1,
+                    "sl": (bits >> 21) & 1,
+                    "l": (bits >> 22) & 1,
+                    "zl": (bits >> 23) & 1,
                 }
             },
             "analog-sticks": {
                 "left": {
-                    "horizontal": self.get_stick_left_horizontal(),
-                    "vertical": self.get_stick_left_vertical(),
+                    "horizontal": stick_left[0],
+                    "vertical": stick_left[1],
                 },
                 "right": {
-                    "horizontal": self.get_stick_right_horizontal(),
-                    "vertical": self.get_stick_right_vertical(),
+                    "horizontal": stick_right[0],
+                    "vertical": stick_right[1],
                 },
             },
-            "accel": self.get_accels(),
+            "accel": self._get_accels(r),
         }
 
+    def set_player_lamp_on(self, on_pattern):
+        self._write_output_report(
+            b'\x01', b'\x30', (on_pattern & 0xF).to_bytes(1, byteorder='little'),
+            skip_unchanged=True)
+
     def disconnect_device(self):
         self._write_output_report(b'\x01', b'\x06', b'\x00')
 
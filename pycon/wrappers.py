@@ -50,17 +50,11 @@ class PythonicJoyCon(JoyCon):
 
     @property
     def stick_l(self):
-        return (
-            self.get_stick_left_horizontal(),
-            self.get_stick_left_vertical(),
-        )
+        return self._get_stick_values(self._input_report) if self.is_left() else (0, 0)
 
     @property
     def stick_r(self):
-        return (
-            self.get_stick_right_horizontal(),
-            self.get_stick_right_vertical(),
-        )
+        return (0, 0) if self.is_left() else self._get_stick_values(self._input_report)
 
     @property
     def accel(self):